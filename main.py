@@ -1,13 +1,25 @@
+import hashlib
+import itertools
 import os
-import uuid
 import random
+import threading
+import time
+from functools import lru_cache
 from io import BytesIO
+from queue import Empty, Queue
 
-from flask import Flask, request, send_file
+from cachetools import TTLCache
+from flask import Flask, redirect, request
+from flask_caching import Cache
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image, ImageDraw, ImageFont
 
 app = Flask(__name__)
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 60})
 
 # --------------------------
 # Config
@@ -15,6 +27,11 @@ app = Flask(__name__)
 
 BIBLE_API_URL = "https://labs.bible.org/api/?passage=random&type=json"
 PEXELS_API_KEY = os.getenv("PEXELS_API_KEY")
+# JPEG by default; IMAGE_FORMAT=PNG serves lossless 24-bit PNG. Clients that
+# do not accept JPEG at all get a smaller 8-bit palette PNG instead.
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+if IMAGE_FORMAT not in ("JPEG", "PNG"):
+    raise ValueError(f"IMAGE_FORMAT must be JPEG or PNG, got {IMAGE_FORMAT!r}")
 
 NATURE_QUERIES = [
     "forest",
@@ -28,16 +45,45 @@ NATURE_QUERIES = [
     "mountain sky",
 ]
 
-VERSE_CACHE = {}
+# The caches and pools below are per-process, and /vimg keys must resolve in
+# the process that issued them, so the app runs as a single (threaded)
+# gunicorn worker; see Procfile.
+
+# Queries are shuffled once per process and then taken round-robin.
+_QUERY_CYCLE = itertools.cycle(random.sample(NATURE_QUERIES, len(NATURE_QUERIES)))
+
+# Keys handed out by /votd_combo that are never redeemed age out here. Keys
+# are content-addressed, so entries are deduplicated and small; they live as
+# long as /vimg responses may be cached downstream (max-age=86400).
+VERSE_CACHE = TTLCache(maxsize=4096, ttl=86400)
+VERSE_CACHE_LOCK = threading.Lock()
+
+# Rendered /vimg bodies by (key, format), so repeat fetches skip rendering.
+# Kept as long as responses are marked immutable downstream (max-age=86400).
+IMG_CACHE = TTLCache(maxsize=256, ttl=86400)
+IMG_CACHE_LOCK = threading.Lock()
+
+# One 30-photo Pexels search per query, picked from locally until it expires.
+PHOTO_URL_CACHE = TTLCache(maxsize=len(NATURE_QUERIES), ttl=1800)
+PHOTO_URL_CACHE_LOCK = threading.Lock()
+
+# Shared so outbound calls reuse pooled keep-alive connections.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2)))
+_SESSION.headers.update({"User-Agent": "bible-votd-api"})
+
+WIDTH, HEIGHT = 1400, 788
 
 # --------------------------
 # Helpers
 # --------------------------
 
 def get_random_verse():
-    resp = requests.get(BIBLE_API_URL, timeout=5)
+    resp = _SESSION.get(BIBLE_API_URL, timeout=5)
     resp.raise_for_status()
-    data = resp.json()
+    data = orjson.loads(resp.content)
 
     if isinstance(data, list) and data:
         verse = data[0]
@@ -51,6 +97,11 @@ def get_random_verse():
     raise ValueError("Empty response from Bible API")
 
 
+def verse_key(ref, text):
+    # Content-addressed, so the same verse always maps to one cache entry.
+    return hashlib.blake2b(f"{ref}|{text}".encode(), digest_size=8).hexdigest()
+
+
 def load_fonts():
     try:
         base_font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
@@ -64,88 +115,245 @@ def load_fonts():
     return verse_font, ref_font, tag_font
 
 
-def wrap_text_pixels(text, font, draw, max_width):
+@lru_cache(maxsize=4096)
+def _text_width(font, text):
+    return font.getlength(text)
+
+
+@lru_cache(maxsize=1024)
+def wrap_text_pixels(text, font, max_width):
     words = text.split()
+    if not words:
+        return (_measured_line(text, font),)
+
+    space_width = _text_width(font, " ")
+    widths = [_text_width(font, w) for w in words]
+    n = len(words)
+
+    # Minimum-raggedness fit: cost[i] is the least total squared slack for
+    # laying out words[:i], breaks[i] where its last line starts. The final
+    # line is left ragged for free.
+    cost = [0.0] + [float("inf")] * n
+    breaks = [0] * (n + 1)
+
+    for i in range(1, n + 1):
+        line_width = -space_width
+        for j in range(i - 1, -1, -1):
+            line_width += space_width + widths[j]
+            if line_width > max_width and j < i - 1:
+                break
+            slack = 0 if i == n else max(max_width - line_width, 0)
+            if cost[j] + slack * slack < cost[i]:
+                cost[i] = cost[j] + slack * slack
+                breaks[i] = j
+
     lines = []
-    line = ""
+    i = n
+    while i > 0:
+        lines.append(" ".join(words[breaks[i]:i]))
+        i = breaks[i]
 
-    for w in words:
-        test_line = w if not line else line + " " + w
-        bbox = draw.textbbox((0, 0), test_line, font=font)
-        if bbox[2] - bbox[0] <= max_width:
-            line = test_line
-        else:
-            if line:
-                lines.append(line)
-            line = w
+    return tuple(_measured_line(line, font) for line in reversed(lines))
 
-    if line:
-        lines.append(line)
 
-    return lines or [text]
+def _measured_line(line, font):
+    left, _, right, bottom = font.getbbox(line)
+    return line, right - left, bottom
 
 
 def create_gradient_background(width, height):
-    img = Image.new("RGB", (width, height))
-    draw = ImageDraw.Draw(img)
+    top_color = np.array((60, 35, 120), dtype=np.float32)
+    bottom_color = np.array((10, 25, 70), dtype=np.float32)
+
+    ratio = (np.arange(height, dtype=np.float32) / height)[:, None]
+    rows = (top_color * (1 - ratio) + bottom_color * ratio).astype(np.uint8)
+    arr = np.broadcast_to(rows[:, None, :], (height, width, 3)).copy()
+
+    return Image.fromarray(arr, "RGB")
 
-    top_color = (60, 35, 120)
-    bottom_color = (10, 25, 70)
 
-    for y in range(height):
-        ratio = y / height
-        r = int(top_color[0] * (1 - ratio) + bottom_color[0] * ratio)
-        g = int(top_color[1] * (1 - ratio) + bottom_color[1] * ratio)
-        b = int(top_color[2] * (1 - ratio) + bottom_color[2] * ratio)
-        draw.line([(0, y), (width, y)], fill=(r, g, b))
+# Darkening by a black overlay at alpha 110 is a constant per-channel scale,
+# applied as a fixed-point multiply (x * scale >> 8).
+_DARKEN_SCALE = round(256 * (255 - 110) / 255)
 
+def stamp_watermark(img):
+    draw = ImageDraw.Draw(img)
+    draw.text((img.width-24, img.height-24), "/Versep PwimpMyWide",
+              fill=(200,200,230), font=_TAG_FONT, anchor="rd")
     return img
 
 
-def get_pexels_background(width, height):
-    if not PEXELS_API_KEY:
-        return create_gradient_background(width, height)
+# Built once per process; requests draw on copies of these. Backgrounds
+# already carry the watermark, so only the verse is drawn per request.
+_VERSE_FONT, _REF_FONT, _TAG_FONT = load_fonts()
+_TEMPLATE = stamp_watermark(create_gradient_background(WIDTH, HEIGHT))
 
-    try:
-        headers = {"Authorization": PEXELS_API_KEY}
-        query = random.choice(NATURE_QUERIES)
-        params = {"query": query, "per_page": 1, "orientation": "landscape"}
-        resp = requests.get("https://api.pexels.com/v1/search",
-                            headers=headers, params=params, timeout=5)
-        resp.raise_for_status()
-        data = resp.json()
-
-        photo = data.get("photos", [])[0]
-        img_url = photo["src"].get("landscape") or photo["src"].get("original")
-
-        img_resp = requests.get(img_url, timeout=10)
+
+def search_pexels_photo_urls(query):
+    headers = {"Authorization": PEXELS_API_KEY}
+    params = {"query": query, "per_page": 30, "orientation": "landscape"}
+    resp = _SESSION.get("https://api.pexels.com/v1/search",
+                        headers=headers, params=params, timeout=5)
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+
+    urls = [photo["src"].get("landscape") or photo["src"].get("original")
+            for photo in data.get("photos", [])]
+    if not urls:
+        raise ValueError("Empty response from Pexels API")
+    return urls
+
+
+def get_pexels_photo_url():
+    query = next(_QUERY_CYCLE)
+    with PHOTO_URL_CACHE_LOCK:
+        urls = PHOTO_URL_CACHE.get(query)
+    if urls is None:
+        urls = search_pexels_photo_urls(query)
+        with PHOTO_URL_CACHE_LOCK:
+            PHOTO_URL_CACHE[query] = urls
+    return random.choice(urls)
+
+
+def get_pexels_background(img_url, width, height):
+    with _SESSION.get(img_url, timeout=10, stream=True) as img_resp:
         img_resp.raise_for_status()
+        img_resp.raw.decode_content = True
+        bg_img = Image.open(img_resp.raw)
+        # Let libjpeg downscale by 1/2..1/8 during decode, never below target.
+        bg_img.draft("RGB", (width, height))
+        bg_img = bg_img.convert("RGB")
+
+    bg_img = bg_img.resize((width, height), Image.BILINEAR)
+
+    arr = np.asarray(bg_img, dtype=np.uint16)
+    arr *= _DARKEN_SCALE
+    arr >>= 8
+    return Image.fromarray(arr.astype(np.uint8), "RGB")
+
+
+# Verses and Pexels backgrounds are prefetched into pools by daemon threads
+# so handlers rarely wait on an outbound call.
+VERSE_POOL = Queue(maxsize=32)
+BG_POOL = Queue(maxsize=8)
+
+# Recently served Pexels templates by photo URL, reused while BG_POOL refills
+# instead of dropping straight to the gradient.
+BG_CACHE = TTLCache(maxsize=8, ttl=600)
+BG_CACHE_LOCK = threading.Lock()
+_FILLERS = {}
+_FILLERS_LOCK = threading.Lock()
+
+
+def _fill_pool(pool, produce):
+    while True:
+        try:
+            pool.put(produce())
+        except Exception:
+            time.sleep(5)
+
+
+def _ensure_filler(name, pool, produce):
+    # Started lazily so every (forked) worker process runs its own filler.
+    with _FILLERS_LOCK:
+        thread = _FILLERS.get(name)
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_fill_pool, args=(pool, produce),
+                                      name=f"{name}-filler", daemon=True)
+            thread.start()
+            _FILLERS[name] = thread
+
+
+def get_verse():
+    _ensure_filler("verse", VERSE_POOL, get_random_verse)
+    try:
+        return VERSE_POOL.get_nowait()
+    except Empty:
+        return get_random_verse()
 
-        bg_img = Image.open(BytesIO(img_resp.content)).convert("RGB")
-        bg_img = bg_img.resize((width, height), Image.LANCZOS)
 
-        overlay = Image.new("RGBA", (width, height), (0, 0, 0, 110))
-        return Image.alpha_composite(bg_img.convert("RGBA"), overlay).convert("RGB")
+def _next_pexels_template():
+    img_url = get_pexels_photo_url()
+    return img_url, stamp_watermark(get_pexels_background(img_url, WIDTH, HEIGHT))
 
-    except Exception:
-        return create_gradient_background(width, height)
+
+def get_background():
+    if PEXELS_API_KEY:
+        _ensure_filler("background", BG_POOL, _next_pexels_template)
+    try:
+        img_url, template = BG_POOL.get_nowait()
+    except Empty:
+        with BG_CACHE_LOCK:
+            BG_CACHE.expire()
+            recent = list(BG_CACHE.values())
+        template = random.choice(recent) if recent else _TEMPLATE
+        return template.copy()
+
+    with BG_CACHE_LOCK:
+        BG_CACHE[img_url] = template
+    return template.copy()
+
+
+def render_verse_image(ref, text):
+    width, height = WIDTH, HEIGHT
+    img = get_background()
+    draw = ImageDraw.Draw(img)
+
+    verse_font, ref_font = _VERSE_FONT, _REF_FONT
+
+    lines = wrap_text_pixels(text, verse_font, width - 320)
+    block_h = sum(line_h for _, _, line_h in lines) + 12 * (len(lines) - 1)
+    y = (height - block_h) // 2
+
+    for line, line_w, line_h in lines:
+        x = (width - line_w) // 2
+        draw.text((x, y), line, fill=(245,245,255), font=verse_font)
+        y += line_h + 12
+
+    draw.text((width//2, y+30), ref, fill=(220,220,255), font=ref_font, anchor="mm")
+    return img
+
+
+def encode_image(img, fmt, palette=False):
+    buf = BytesIO()
+    if fmt == "PNG":
+        if palette:
+            # Lossy: a third of the bytes to deflate, some gradient banding.
+            img = img.quantize(colors=256, method=Image.FASTOCTREE, dither=Image.NONE)
+        img.save(buf, format="PNG", compress_level=1, optimize=False)
+    else:
+        img.save(buf, format="JPEG", quality=85, optimize=False, progressive=False)
+    return buf.getvalue()
+
+
+def negotiate_image_format():
+    if IMAGE_FORMAT == "PNG":
+        return "PNG"
+    # JPEG whenever it is acceptable at all (directly, via image/* or */*, or
+    # no Accept header); PNG only for clients that rule JPEG out.
+    accept = request.accept_mimetypes
+    if not accept.provided or accept.quality("image/jpeg") > 0:
+        return "JPEG"
+    return "PNG"
 
 # --------------------------
 # Routes
 # --------------------------
 
 @app.route("/")
+@cache.cached(timeout=3600)
 def home():
     return "Bible VOTD service is running."
 
 @app.route("/healthz")
+@cache.cached(timeout=3600)
 def healthz():
     return "OK", 200
 
 @app.route("/votd")
 def votd_text():
     try:
-        ref, text = get_random_verse()
+        ref, text = get_verse()
         return f'{ref} - "{text}"'
     except Exception:
         return "Error fetching verse."
@@ -153,47 +361,72 @@ def votd_text():
 @app.route("/votd_combo")
 def votd_combo():
     try:
-        ref, text = get_random_verse()
-        key = uuid.uuid4().hex
-        VERSE_CACHE[key] = (ref, text)
+        ref, text = get_verse()
+        key = verse_key(ref, text)
+        with VERSE_CACHE_LOCK:
+            VERSE_CACHE[key] = (ref, text)
         base = request.url_root.rstrip("/")
         return f'{ref} - "{text}" | Click for pic: {base}/vimg/{key}'
     except Exception:
         return "Error generating verse."
 
+@app.route("/vbg")
+def verse_background():
+    # Background only: send the client straight to Pexels, no pixel work here.
+    if not PEXELS_API_KEY:
+        return "Backgrounds are not configured.", 404
+    try:
+        return redirect(get_pexels_photo_url(), code=302)
+    except Exception:
+        return "Error fetching background.", 502
+
 @app.route("/vimg/<key>")
 def verse_image(key):
-    verse = VERSE_CACHE.pop(key, None)
-    if verse is None:
-        verse = get_random_verse()
-
-    ref, text = verse
-    width, height = 1400, 788
-    img = get_pexels_background(width, height)
-    draw = ImageDraw.Draw(img)
-
-    verse_font, ref_font, tag_font = load_fonts()
-
-    lines = wrap_text_pixels(text, verse_font, draw, width - 320)
-    y = (height - sum(draw.textbbox((0,0), l, font=verse_font)[3] for l in lines)) // 2
-
-    for line in lines:
-        bbox = draw.textbbox((0,0), line, font=verse_font)
-        x = (width - (bbox[2]-bbox[0])) // 2
-        draw.text((x, y), line, fill=(245,245,255), font=verse_font)
-        y += bbox[3] + 12
-
-    draw.text((width//2, y+30), ref, fill=(220,220,255), font=ref_font, anchor="mm")
-    draw.text((width-24, height-24), "/Versep PwimpMyWide",
-              fill=(200,200,230), font=tag_font, anchor="rd")
-
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return send_file(buf, mimetype="image/png")
+    fmt = negotiate_image_format()
+    # Only negotiated PNG is quantized; a configured PNG stays lossless.
+    palette = fmt == "PNG" and IMAGE_FORMAT != "PNG"
+    other_fmt = "PNG" if fmt == "JPEG" else "JPEG"
+    with IMG_CACHE_LOCK:
+        cached = IMG_CACHE.get((key, fmt))
+        other = IMG_CACHE.get((key, other_fmt))
+
+    if cached is None and other is not None:
+        # Re-encode the other variant so both formats show the same photo.
+        img = Image.open(BytesIO(other[0])).convert("RGB")
+        data = encode_image(img, fmt, palette)
+        etag = hashlib.blake2b(data, digest_size=8).hexdigest()
+        cached = (data, etag, other[2])
+        with IMG_CACHE_LOCK:
+            IMG_CACHE[(key, fmt)] = cached
+
+    if cached is None:
+        with VERSE_CACHE_LOCK:
+            verse = VERSE_CACHE.get(key)
+        if verse is None:
+            # Unknown or expired key: show a fresh verse, but never pin it to
+            # this URL on our side or in any downstream cache.
+            data = encode_image(render_verse_image(*get_verse()), fmt, palette)
+            response = app.response_class(data, mimetype=f"image/{fmt.lower()}")
+            response.headers["Cache-Control"] = "no-store"
+            return response
+
+        data = encode_image(render_verse_image(*verse), fmt, palette)
+        etag = hashlib.blake2b(data, digest_size=8).hexdigest()
+        cached = (data, etag, time.time())
+        with IMG_CACHE_LOCK:
+            IMG_CACHE[(key, fmt)] = cached
+
+    data, etag, rendered_at = cached
+    response = app.response_class(data, mimetype=f"image/{fmt.lower()}")
+    response.vary.add("Accept")
+    response.set_etag(etag)
+    response.last_modified = rendered_at
+    response.headers["Cache-Control"] = "public, max-age=86400, immutable"
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=len(data))
 
 # --------------------------
-# Run app (Render-compatible)
+# Run app (local development; production runs gunicorn, see Procfile)
 # --------------------------
 
 if __name__ == "__main__":